@@ -1,16 +1,46 @@
 """Adds Metal Archives album search support to the beets autotagger.
 """
+import functools
+import itertools
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import metallum
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from beets.autotag.hooks import AlbumInfo, TrackInfo, Distance, string_dist
 from beets.plugins import BeetsPlugin
 from beets import config, ui
 from iso3166 import countries
 
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
 log = logging.getLogger('beets')
 
 DATA_SOURCE = 'Metal Archives'
 ID_PREFIX = 'ma-'
+_PREFIX_LEN = len(ID_PREFIX)
+
+# Persistent page cache, set up by the plugin when enabled
+_cache = None
+_cache_ttl = None
+
+# Session shared by all metallum page requests, set up by the plugin
+_session = None
+
+# Page requests are made one at a time, and holding the lock through the
+# throttle keeps the request rate to Metal Archives the same as metallum's own.
+# This also serializes the shared session's reads and writes to metallum's
+# sqlite response cache. The sessions metallum still builds for each page
+# open their own sqlite connections outside the lock, but they only create
+# the cache table if it is missing, and sqlite's file locking handles that
+_request_lock = threading.Lock()
 
 
 def _add_prefix(id):
@@ -22,13 +52,57 @@ def _add_prefix(id):
 def _strip_prefix(id):
     """Strip source id prefix from id
     """
-    return id[len(ID_PREFIX):]
+    return id[_PREFIX_LEN:]
 
 
 def _is_source_id(id):
     """Check if an id string contains the source id prefix
     """
-    return id[:len(ID_PREFIX)] == ID_PREFIX
+    return id.startswith(ID_PREFIX)
+
+
+@functools.lru_cache(maxsize=512)
+def _country_alpha2(name):
+    """Get the ISO 3166 alpha-2 code for a country name
+    """
+    try:
+        return countries.get(name).alpha2
+    except KeyError:
+        return ''
+
+
+def _throttle_hook(response, *args, **kwargs):
+    """Wait between uncached requests, as metallum's own sessions do
+    """
+    if not getattr(response, 'from_cache', False):
+        time.sleep(metallum.REQUEST_TIMEOUT)
+    return response
+
+
+def _download_page(url):
+    """Fetch a page through the shared session
+    """
+    with _request_lock:
+        return _session.get(metallum.make_absolute(url))
+
+
+def _fetch_page_content(page, url):
+    """Replacement for metallum's page fetcher that downloads through the
+    shared session and, when enabled, keeps the raw page text in the
+    persistent cache, keyed on its url
+    """
+    if _cache is None:
+        return _download_page(url).text
+
+    key = metallum.make_absolute(url)
+    content = _cache.get(key)
+    if content is None:
+        response = _download_page(url)
+        content = response.text
+        # Don't keep error pages, such as when being rate limited
+        if response.ok:
+            _cache.set(key, content, expire=_cache_ttl)
+    return content
 
 
 class MetalArchivesPlugin(BeetsPlugin):
@@ -39,13 +113,60 @@ class MetalArchivesPlugin(BeetsPlugin):
             'lyrics': False,
             'lyrics_search': False,
             'instrumental': '',
+            'parallel_workers': 2,
+            'cache_enabled': False,
+            'cache_ttl': 7 * 24 * 60 * 60,
         })
+        self.patch_metallum()
+        self.setup_cache()
+        self.setup_session()
 
         stages = []
         if self.config['lyrics'].get(bool):
             stages.append(self.fetch_lyrics)
         self.import_stages = stages
 
+    def patch_metallum(self):
+        """Route all metallum page fetches through this module, which is where
+        both the shared session and the page cache are used.
+        """
+        metallum.Metallum._fetch_page_content = _fetch_page_content
+
+    def setup_cache(self):
+        """Open the persistent page cache if it is enabled and available.
+        """
+        global _cache, _cache_ttl
+
+        if not self.config['cache_enabled'].get(bool):
+            return
+        if diskcache is None:
+            self._log.debug(u'diskcache is not installed, pages will not be cached')
+            return
+
+        _cache_ttl = self.config['cache_ttl'].as_number()
+        _cache = diskcache.Cache(os.path.join(config.config_dir(), 'metalarchives'))
+
+    def setup_session(self):
+        """Share one session between all metallum page requests so connections
+        to Metal Archives are kept alive and reused. Like the sessions metallum
+        creates for each page, it uses metallum's response cache, headers and
+        throttle.
+        """
+        global _session
+
+        pool_size = max(16, self.config['parallel_workers'].get(int))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        session = requests_cache.CachedSession(cache_name=metallum.CACHE_FILE)
+        session.hooks = {'response': _throttle_hook}
+        session.headers = {
+            'User-Agent': metallum.USER_AGENT,
+            'Accept-Encoding': 'gzip'
+        }
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+
     def commands(self):
         cmd = ui.Subcommand('metalarchives', help='metal archives data source')
         cmd.parser.add_option('-l', '--lyrics', dest='lyrics',
@@ -54,8 +175,7 @@ class MetalArchivesPlugin(BeetsPlugin):
 
         def func(lib, opts, args):
             if opts.lyrics:
-                for item in lib.items(ui.decargs(args)):
-                    self.fetch_item_lyrics(item)
+                self.fetch_items_lyrics(lib, lib.items(ui.decargs(args)))
 
         cmd.func = func
         return [cmd]
@@ -74,9 +194,29 @@ class MetalArchivesPlugin(BeetsPlugin):
         """
         return self.get_albums(artist, album)
 
+    def _lyrics_options(self):
+        """Read the config options used when fetching lyrics, so they can be
+        looked up once per batch of items.
+        """
+        return {
+            'write': config['import']['write'].get(bool),
+            'search_enabled': self.config['lyrics_search'].get(bool),
+            'instrumental': self.config['instrumental'].get(),
+        }
+
     def fetch_item_lyrics(self, item):
         """Fetch track lyrics from Metal Archives
         """
+        options = self._lyrics_options()
+        lyrics = self._fetch_lyrics_network(item, search_enabled=options['search_enabled'])
+        self._apply_lyrics(item, lyrics, write=options['write'],
+                           instrumental=options['instrumental'])
+
+    def _fetch_lyrics_network(self, item, search_enabled):
+        """Look up lyrics for an item on Metal Archives without modifying it.
+        Returns the lyrics string (empty if none were found), or None if the
+        item should be left untouched.
+        """
         lyrics = ''
 
         # Skip if lyrics are already present
@@ -86,9 +226,12 @@ class MetalArchivesPlugin(BeetsPlugin):
         # If this track was matched from metal archives, we can just use
         # the track id
         if _is_source_id(item.mb_albumid):
-            self._log.debug(u'fetching lyrics: {0.artist} - {0.title}', item)
-
             track_id = _strip_prefix(item.mb_trackid)
+            if not track_id.isdecimal():
+                self._log.debug(u'invalid track id: {0.mb_trackid}', item)
+                return
+
+            self._log.debug(u'fetching lyrics: {0.artist} - {0.title}', item)
             try:
                 lyrics = metallum.lyrics_for_id(track_id)
             except metallum.NetworkError as e:
@@ -96,7 +239,7 @@ class MetalArchivesPlugin(BeetsPlugin):
                 return
 
         # Otherwise perform an album search
-        elif self.config['lyrics_search'].get(bool):
+        elif search_enabled:
             self._log.debug(u'searching for lyrics: {0.artist} - {0.title}', item)
 
             try:
@@ -125,13 +268,20 @@ class MetalArchivesPlugin(BeetsPlugin):
         else:
             return
 
+        return str(lyrics) if lyrics else ''
+
+    def _apply_lyrics(self, item, lyrics, write, instrumental):
+        """Store fetched lyrics on an item and report the result.
+        """
+        if lyrics is None:
+            return
+
         if lyrics:
-            lyrics = str(lyrics)
             message = ui.colorize('text_success', 'found lyrics')
             if lyrics == '(<em>Instrumental</em>)':
-                lyrics = self.config['instrumental'].get()
+                lyrics = instrumental
             item.lyrics = lyrics
-            if config['import']['write'].get(bool):
+            if write:
                 item.try_write()
             item.store()
         else:
@@ -142,8 +292,40 @@ class MetalArchivesPlugin(BeetsPlugin):
     def fetch_lyrics(self, session, task):
         """Fetch lyrics from Metal Archives for each track
         """
-        for item in task.imported_items():
-            self.fetch_item_lyrics(item)
+        self.fetch_items_lyrics(session.lib, task.imported_items())
+
+    def fetch_items_lyrics(self, lib, items):
+        """Fetch lyrics from Metal Archives for an iterable of items
+        """
+        # Lookups run concurrently, a chunk of items at a time. Each chunk is
+        # written on this thread in a single transaction once its lookups have
+        # finished, so the database isn't held while waiting on the network
+        # and an interrupted run keeps the lyrics already found
+        options = self._lyrics_options()
+        fetch = functools.partial(self._fetch_item_lyrics_safe,
+                                  search_enabled=options['search_enabled'])
+        workers = max(self.config['parallel_workers'].get(int), 1)
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                chunk = list(itertools.islice(items, workers))
+                if not chunk:
+                    break
+                results = list(executor.map(fetch, chunk))
+                with lib.transaction():
+                    for item, lyrics in zip(chunk, results):
+                        self._apply_lyrics(item, lyrics, write=options['write'],
+                                           instrumental=options['instrumental'])
+
+    def _fetch_item_lyrics_safe(self, item, search_enabled):
+        """Look up lyrics for an item, logging any error instead of raising
+        it so that one failed lookup doesn't abort the rest of the batch.
+        """
+        try:
+            return self._fetch_lyrics_network(item, search_enabled)
+        except Exception as e:
+            self._log.debug(u'error fetching lyrics: {0.artist} - {0.title}: {1}', item, e)
+            return None
 
     def album_for_id(self, album_id):
         """Fetches an album by its Metal Archives ID and returns an AlbumInfo object
@@ -152,8 +334,13 @@ class MetalArchivesPlugin(BeetsPlugin):
         if not _is_source_id(album_id):
             return
 
+        stripped_id = _strip_prefix(album_id)
+        if not stripped_id.isdecimal():
+            self._log.debug(u'invalid album id: {0}', album_id)
+            return
+
         try:
-            result = metallum.album_for_id(_strip_prefix(album_id))
+            result = metallum.album_for_id(stripped_id)
         except metallum.NetworkError as e:
             self._log.debug('network error: {0}', e)
             return
@@ -170,30 +357,42 @@ class MetalArchivesPlugin(BeetsPlugin):
             self._log.debug('network error: {0}', e)
             return
 
-        for result in results:
-            try:
-                album = result.get()
-            except metallum.NetworkError as e:
-                self._log.debug('network error: {0}', e)
-                continue
-            albums.append(self.get_album_info(album))
+        if not results:
+            return albums
+
+        # Fetching a result and reading its bands and tracks are all blocking
+        # requests, so build each AlbumInfo on the pool and collect them in
+        # search order as they become ready
+        workers = min(self.config['parallel_workers'].get(int), len(results))
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = [executor.submit(self._get_result_info, result) for result in results]
+            for future in futures:
+                info = future.result()
+                if info is not None:
+                    albums.append(info)
 
         return albums
 
+    def _get_result_info(self, result):
+        """Returns an AlbumInfo object for a search result, or None on network error.
+        """
+        try:
+            return self.get_album_info(result.get())
+        except metallum.NetworkError as e:
+            self._log.debug('network error: {0}', e)
+            return None
+
     def get_album_info(self, album):
         """Returns an AlbumInfo object for a Metal Archives album object.
         """
-        artist = album.bands[0]
+        bands = album.bands
+        artist = bands[0]
         tracks = self.get_tracks(album.tracks)
         album_id = _add_prefix(album.id)
         artist_id = _add_prefix(artist.id)
+        country = _country_alpha2(artist.country)
 
-        try:
-            country = countries.get(artist.country).alpha2
-        except KeyError:
-            country = ''
-
-        band_names = " / ".join([band.name for band in album.bands])
+        band_names = " / ".join([band.name for band in bands])
         return AlbumInfo(album.title, album_id, band_names, artist_id, tracks,
                          albumtype=album.type, va=False, year=album.year, month=album.date.month,
                          day=album.date.day, label=album.label, mediums=album.disc_count,
@@ -202,18 +401,16 @@ class MetalArchivesPlugin(BeetsPlugin):
     def get_tracks(self, tracklist):
         """Returns a list of TrackInfo objects for a Metal Archives tracklist.
         """
-        tracks = []
-        for track in tracklist:
-            tracks.append(self.get_track_info(track))
-        return tracks
+        return [self.get_track_info(track) for track in tracklist]
 
     def get_track_info(self, track):
         """Returns a TrackInfo object for a Metal Archives track object.
         """
+        band = track.band
         track_id = _add_prefix(track.id)
-        artist_id = _add_prefix(track.band.id)
+        artist_id = _add_prefix(band.id)
         return TrackInfo(track.title, track_id,
-                         artist=track.band.name,
+                         artist=band.name,
                          artist_id=artist_id,
                          length=track.duration,
                          index=track.overall_number,